@@ -0,0 +1,238 @@
+from typing import Any, Optional
+import json
+import sys
+
+from convert import ContextRecorder, convert_stream, parse_time, process_role
+from query import normalize_p_table
+
+
+class TraceStats:
+    """
+    イベントレコードを1件ずつ受け取って集計する
+    保持するのは集計値と生存中のプロセス/fdだけなのでログの長さによらずメモリは一定
+    """
+
+    def __init__(self):
+        self.first_pid: Optional[int] = None
+        self.first_time: Optional[str] = None
+        self.last_time: Optional[str] = None
+        self.duration = 0.0
+        self.n_events = 0
+
+        # (role, event) -> [回数, バイト数]
+        self.counts: "dict[tuple[str, str], list[int]]" = {}
+        self.path_io: "dict[str, list[int]]" = {}  # path -> [read, write]
+        self.files: "dict[str, int]" = {}  # path -> open回数
+        self.sockets: "dict[str, int]" = {}  # bind/connect先 -> 回数
+
+        self.fds: "dict[tuple[int, int], str]" = {}  # (pid, fd) -> path
+        self.memory: "dict[int, int]" = {}  # pid -> memory
+        # role -> そのroleのプロセス単体での最大メモリ使用量
+        # cloneした子プロセスは親のmmap(shared_buffersを含む)を引き継ぐので、
+        # プロセス間で合計すると共有分を重複して数えてしまう
+        self.role_peak: "dict[str, int]" = {}
+
+    def add(self, record: "dict[str, Any]"):
+        time_part = record["time"]
+        if self.first_time is None:
+            self.first_time = time_part
+        else:
+            d = parse_time(time_part) - parse_time(self.last_time)
+            if d < -12 * 3600:  # 日付をまたいだ
+                d += 24 * 3600
+            self.duration += max(d, 0.0)
+        self.last_time = time_part
+        self.n_events += 1
+
+        evt = record["event"]
+        name = evt["name"]
+        pid = evt["pid"]
+        if name == "add_proc" and self.first_pid is None:
+            self.first_pid = pid
+        role = process_role(pid, self.first_pid)
+
+        c = self.counts.setdefault((role, name), [0, 0])
+        c[0] += 1
+        if name in ("read_fd", "write_fd"):
+            c[1] += evt["len"]
+        elif name == "flush_fd":
+            c[1] += evt["dirty"]
+
+        if name == "add_proc":
+            p = record["p_table"][pid]
+            for fd, f in p["fd_table"].items():
+                self.open_fd(pid, fd, f)
+            self.manip_mem(pid, role, p["memory"])
+        elif name == "close_proc":
+            for key in [k for k in self.fds if k[0] == pid]:
+                del self.fds[key]
+            self.memory.pop(pid, None)
+        elif name in ("open_fd", "accept"):
+            f = record["p_table"][pid]["fd_table"][evt["fd"]]
+            self.open_fd(pid, evt["fd"], f)
+            if f["class"] == "SFile":
+                self.files[f["target"]] = self.files.get(f["target"], 0) + 1
+        elif name == "close_fd":
+            self.fds.pop((pid, evt["fd"]), None)
+        elif name in ("read_fd", "write_fd"):
+            path = self.fds.get((pid, evt["fd"]))
+            if path is not None:
+                io = self.path_io.setdefault(path, [0, 0])
+                io[0 if name == "read_fd" else 1] += evt["len"]
+        elif name == "bind":
+            key = f'{evt["family"]} bind {evt["bind"]}'
+            self.sockets[key] = self.sockets.get(key, 0) + 1
+        elif name == "connect":
+            key = f'{evt["family"]} connect {evt["target"]}'
+            self.sockets[key] = self.sockets.get(key, 0) + 1
+        elif name == "manip_mem":
+            self.manip_mem(pid, role, self.memory.get(pid, 0) + evt["amount"])
+
+    def open_fd(self, pid: int, fd: int, f: "dict[str, Any]"):
+        if f["class"] == "SFile":
+            self.fds[(pid, fd)] = f["target"]
+        else:
+            self.fds.pop((pid, fd), None)
+
+    def manip_mem(self, pid: int, role: str, memory: int):
+        self.memory[pid] = memory
+        self.role_peak[role] = max(self.role_peak.get(role, 0), memory)
+
+
+def collect(fname: str) -> TraceStats:
+    """
+    straceログまたは変換済みjsonl(.jsonl)を1回なめて集計する
+    """
+    stats = TraceStats()
+    with open(fname) as f:
+        if fname.endswith(".jsonl"):
+            for l in f:
+                if len(l.strip()) == 0:
+                    continue
+                record = json.loads(l)
+                if record["p_table"] is not None:
+                    record["p_table"] = normalize_p_table(record["p_table"])
+                stats.add(record)
+        else:
+            convert_stream(f, ContextRecorder(sink=stats.add))
+    return stats
+
+
+def format_table(
+    title: str,
+    rows: "list[tuple[str, float, float]]",
+    limit: Optional[int] = None,
+    digits: int = 3,
+) -> "list[str]":
+    # 差分の絶対値が大きい順
+    rows = sorted(rows, key=lambda r: abs(r[2] - r[1]), reverse=True)
+    if limit is not None:
+        rows = rows[:limit]
+
+    width = max([len(r[0]) for r in rows] + [len(title)])
+    lines = [
+        f"{title:<{width}} {'before':>16} {'after':>16} {'delta':>16} {'ratio':>8}"
+    ]
+    for key, a, b in rows:
+        if a != 0:
+            ratio = f"{(b - a) / a * 100:+.1f}%"
+        else:
+            ratio = "new" if b != 0 else "-"
+        lines.append(
+            f"{key:<{width}} {a:>16.{digits}f} {b:>16.{digits}f} "
+            f"{b - a:>+16.{digits}f} {ratio:>8}"
+        )
+    return lines
+
+
+def compare(
+    before: TraceStats,
+    after: TraceStats,
+    tx_before: Optional[int] = None,
+    tx_after: Optional[int] = None,
+    limit: int = 20,
+) -> str:
+    """
+    parameters
+    ----------
+    tx_before, tx_after:
+        それぞれのトランザクション数 (pgbenchの出力など)
+        指定すればトランザクションあたり、なければ秒あたりに正規化する
+    limit:
+        各表と増減したファイル/ソケットの最大行数 (差分のないものは出さない)
+    """
+    if tx_before is not None and tx_after is not None:
+        unit = "tx"
+        div_a, div_b = tx_before, tx_after
+    else:
+        unit = "sec"
+        div_a, div_b = before.duration, after.duration
+    div_a = div_a if div_a > 0 else 1
+    div_b = div_b if div_b > 0 else 1
+
+    lines = [
+        f"before: {before.n_events} events {before.duration:.3f} sec",
+        f"after:  {after.n_events} events {after.duration:.3f} sec",
+        f"normalized per {unit}",
+        "",
+    ]
+
+    keys = sorted(set(before.counts) | set(after.counts))
+    for i, label in enumerate(("count", "bytes")):
+        rows = []
+        for role, name in keys:
+            a = before.counts.get((role, name), [0, 0])[i]
+            b = after.counts.get((role, name), [0, 0])[i]
+            if a / div_a == b / div_b:
+                continue
+            rows.append((f"{role} {name}", a / div_a, b / div_b))
+        if rows:
+            lines += format_table(f"[{label}/{unit}]", rows, limit)
+            lines.append("")
+
+    paths = set(before.path_io) | set(after.path_io)
+    rows = []
+    for path in paths:
+        a = before.path_io.get(path, [0, 0])
+        b = after.path_io.get(path, [0, 0])
+        rows.append((f"{path} read", a[0] / div_a, b[0] / div_b))
+        rows.append((f"{path} write", a[1] / div_a, b[1] / div_b))
+    rows = [r for r in rows if r[1] != r[2]]
+    if rows:
+        lines += format_table(f"[file bytes/{unit}]", rows, limit)
+        lines.append("")
+
+    for label, a, b in (
+        ("files", before.files, after.files),
+        ("sockets", before.sockets, after.sockets),
+    ):
+        for mark, keys in (("+", set(b) - set(a)), ("-", set(a) - set(b))):
+            keys = sorted(keys)
+            for key in keys[:limit]:
+                lines.append(f"{mark} {label}: {key} ({b.get(key, a.get(key))})")
+            if len(keys) > limit:
+                lines.append(f"{mark} {label}: ... {len(keys) - limit} more")
+    lines.append("")
+
+    rows = [
+        (role, before.role_peak.get(role, 0), after.role_peak.get(role, 0))
+        for role in sorted(set(before.role_peak) | set(after.role_peak))
+    ]
+    lines += format_table("[memory peak bytes per process]", rows, digits=0)
+
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (3, 5):
+        sys.exit(
+            f"usage: python {sys.argv[0]} before after [tx_before tx_after]\n"
+            "transaction counts must be given for both or neither"
+        )
+
+    src_before = sys.argv[1]
+    src_after = sys.argv[2]
+    tx_before = int(sys.argv[3]) if len(sys.argv) == 5 else None
+    tx_after = int(sys.argv[4]) if len(sys.argv) == 5 else None
+
+    print(compare(collect(src_before), collect(src_after), tx_before, tx_after))
@@ -1,4 +1,4 @@
-from typing import Any, Optional, Union
+from typing import Any, Callable, Iterable, Optional, Union
 import copy
 import json
 import re
@@ -14,10 +14,15 @@ class SFile:
         self.flag = flag
         self.r = 0
         self.w = 0
+        self.dirty = 0  # 直前のfsync/fdatasync以降の書き込みバイト数
 
     def __repr__(self):
         return f"File: {self.fd} {self.target} {self.flag}"
 
+    def is_sync(self) -> bool:
+        # O_SYNC/O_DSYNCで開いたファイルは書き込みごとにフラッシュされる
+        return "O_SYNC" in self.flag or "O_DSYNC" in self.flag
+
     def to_dict(self):
         return {
             "class": "SFile",
@@ -115,6 +120,46 @@ def parse_sock_opt(opt: str) -> Optional[Any]:
         return ("AF_INET6", opt_split[3].strip()[1:-1] + "," + opt_split[1].split("(")[1][0:-1])
     return None
 
+
+# viewerのPidToNameと同じ決め打ち (最初のプロセスからのpid差分)
+PROCESS_ROLES = {
+    0: "postmaster",
+    4: "startup",
+    5: "checkpointer",
+    6: "writer",
+    7: "wal writer",
+    8: "autovacuum launcher",
+    9: "stats collector",
+}
+
+
+def process_role(pid: int, first_pid: Optional[int]) -> str:
+    if first_pid is None:
+        return "backend"
+    return PROCESS_ROLES.get(pid - first_pid, "backend")
+
+
+def file_kind(target: str) -> str:
+    if target.startswith("pg_xlog/"):
+        return "wal"
+    elif target.startswith("base/") or target.startswith("global/"):
+        return "relation"
+    return "other"
+
+
+def parse_time(time_part: str) -> float:
+    # 19:40:44.504078 -> 0時からの秒数
+    h, m, sec = time_part.split(":")
+    return int(h) * 3600 + int(m) * 60 + float(sec)
+
+
+def elapsed(start_part: str, end_part: str) -> float:
+    d = parse_time(end_part) - parse_time(start_part)
+    if d < 0:  # 日付をまたいだ
+        d += 24 * 3600
+    return d
+
+
 class SProcess:
     def __init__(self, ppid: int, pid: int, name):
         """
@@ -199,17 +244,38 @@ class SProcess:
 
 
 class ContextRecorder:
-    def __init__(self, fname):
+    def __init__(
+        self,
+        fname: Optional[str] = None,
+        sink: "Optional[Callable[[dict[str, Any]], None]]" = None,
+    ):
+        """
+        parameters
+        ----------
+        fname:
+            出力jsonlファイル名 Noneならファイルに書き出さない
+        sink:
+            イベントレコードごとに呼ばれるコールバック (メモリ上での変換用)
+        """
         self.p_table: "dict[int, SProcess]" = {}
-        self.f = open(fname, "w")
+        self.first_pid: Optional[int] = None
+        self.flush_stats: "dict[str, dict[str, Any]]" = {}
+        self.f = open(fname, "w") if fname is not None else None
+        self.sink = sink
 
     def __del__(self):
-        self.f.close()
+        if self.f is not None:
+            self.f.close()
 
     def __repr__(self) -> str:
         return f"{self.p_table}"
 
+    def role(self, pid: int) -> str:
+        return process_role(pid, self.first_pid)
+
     def add_process(self, ppid, pid, name, time_part):
+        if self.first_pid is None:
+            self.first_pid = pid
         self.p_table[pid] = SProcess(ppid, pid, name)
 
         self.p_table[pid].open_fd(SStd(0))  # stdin
@@ -264,9 +330,18 @@ class ContextRecorder:
                 },
             )
 
-    def write_fd(self, pid: int, fd: int, len: int, content, time_part):
+    def write_fd(
+        self,
+        pid: int,
+        fd: int,
+        len: int,
+        content,
+        time_part,
+        duration: Optional[float] = None,
+    ):
         if pid in self.p_table and fd in self.p_table[pid].fd_table:
-            self.p_table[pid].fd_table[fd].w += len
+            f = self.p_table[pid].fd_table[fd]
+            f.w += len
             self.write(
                 time_part,
                 False,
@@ -278,6 +353,97 @@ class ContextRecorder:
                     "len": len,
                 },
             )
+            if isinstance(f, SFile):
+                f.dirty += len
+                if f.is_sync():
+                    self.flush_fd(pid, fd, "write", len, duration, time_part)
+
+    def flush_fd(
+        self,
+        pid: int,
+        fd: int,
+        syscall: str,
+        amount: int,
+        duration: Optional[float],
+        time_part,
+    ):
+        """
+        parameters
+        ----------
+        syscall:
+            fsync, fdatasync, sync_file_range, write(O_SYNC/O_DSYNC)
+        amount:
+            sync_file_range の対象バイト数 (0はファイル末尾まで)
+            O_SYNC/O_DSYNCの書き込みではその書き込みバイト数 fsync/fdatasyncは0
+        duration:
+            フラッシュにかかった秒数 測れなかった場合(strace -Tなしで中断されなかったコール)はNone
+        """
+        if not (pid in self.p_table and fd in self.p_table[pid].fd_table):
+            return
+        f = self.p_table[pid].fd_table[fd]
+        if not isinstance(f, SFile):
+            return
+
+        role = self.role(pid)
+        dirty = f.dirty
+        # sync_file_rangeは書き出しを開始するだけなので未フラッシュ量は据え置き
+        is_flush = syscall != "sync_file_range"
+        if is_flush:
+            f.dirty = 0
+
+        st = self.flush_stats.setdefault(
+            f.target,
+            {
+                "kind": file_kind(f.target),
+                "roles": {},
+                "flushes": 0,
+                "ranges": 0,
+                "dirty": 0,
+                "timed": 0,  # durationを測れた回数
+                "duration": 0.0,
+                "max_duration": 0.0,
+            },
+        )
+        st["roles"][role] = st["roles"].get(role, 0) + 1
+        if is_flush:
+            st["flushes"] += 1
+            st["dirty"] += dirty
+        else:
+            st["ranges"] += 1
+        if duration is not None:
+            st["timed"] += 1
+            st["duration"] += duration
+            st["max_duration"] = max(st["max_duration"], duration)
+
+        self.write(
+            time_part,
+            False,
+            {
+                "name": "flush_fd",
+                "pid": pid,
+                "fd": fd,
+                "syscall": syscall,
+                "target": f.target,
+                "kind": file_kind(f.target),
+                "role": role,
+                "dirty": dirty,
+                "amount": amount,
+                "duration": duration,
+            },
+        )
+
+    def flush_summary(self) -> "dict[str, dict[str, Any]]":
+        ret = {}
+        for target, st in self.flush_stats.items():
+            d = dict(st)
+            d["dirty_per_flush"] = (
+                st["dirty"] / st["flushes"] if st["flushes"] > 0 else 0
+            )
+            if st["timed"] == 0:
+                d["duration"] = None
+                d["max_duration"] = None
+            ret[target] = d
+        return ret
 
     def accept_sock(self, pid, srcFd: int, fd: int, time_part):
         if pid in self.p_table and srcFd in self.p_table[pid].fd_table:
@@ -352,18 +518,18 @@ class ContextRecorder:
             )
 
     def write(self, time_part: str, with_tree, event_data: Any):
-        self.f.write(
-            json.dumps(
-                {
-                    "time": time_part,
-                    "event": event_data,
-                    "p_table": {k: v.to_dict() for k, v in self.p_table.items()}
-                    if with_tree
-                    else None,
-                }
-            )
-        )
-        self.f.write("\n")
+        record = {
+            "time": time_part,
+            "event": event_data,
+            "p_table": {k: v.to_dict() for k, v in self.p_table.items()}
+            if with_tree
+            else None,
+        }
+        if self.sink is not None:
+            self.sink(record)
+        if self.f is not None:
+            self.f.write(json.dumps(record))
+            self.f.write("\n")
 
 
 class Token(Enum):
@@ -599,126 +765,177 @@ def parse_kill(s: str):
     return {"to": ret[0], "act": ret[1], "ret": ret[2]}
 
 
-def convert(src: str, dst: str):
-    cr = ContextRecorder(dst)
-    pending_events: "dict[int, str]" = {}
+def parse_fsync(s: str):
+    ret = parse_reg(s, (Token.INT,), Token.INT)
+    if ret is None:
+        return None
+    return {"fd": ret[0], "ret": ret[1]}
 
-    with open(src) as f:
-        for l in f:
-            if len(l) == 0:
-                continue
 
-            s = l.strip()
+def parse_sync_file_range(s: str):
+    ret = parse_reg(s, (Token.INT, Token.INT, Token.INT, Token.STR), Token.INT)
+    if ret is None:
+        return None
+    return {"fd": ret[0], "offset": ret[1], "nbytes": ret[2], "ret": ret[4]}
 
-            pid_part, time_part, cmd_part = re.split("\s+", s, 2)
 
-            pid = int(pid_part)
+REG_SYSCALL_TIME = re.compile(r"\s*<(\d+\.\d+)>$")
 
-            if cmd_part.endswith("<unfinished ...>"):
-                pending_events[pid] = cmd_part
-                continue
 
-            if cmd_part.startswith("<..."):
-                # resume
-                cmd_part = (
-                    pending_events.pop(pid)[:-17] + cmd_part[cmd_part.find(">") + 2 :]
-                )
+def convert(src: str, dst: str, flush_dst: Optional[str] = None):
+    cr = ContextRecorder(dst)
 
-            # process
-            if cmd_part.startswith("execve"):
-                ret = parse_execve(cmd_part)
-                cr.add_process(0, pid, ret["name"], time_part)
-            elif cmd_part.startswith("clone"):
-                ret = parse_clone(cmd_part)
-                cr.clone_process(pid, ret["pid"], None, time_part)
-            elif cmd_part.startswith("exit_group"):
-                cr.close_process(pid, time_part)
-
-            # file / socket
-            elif cmd_part.startswith("open"):
-                ret = parse_open(cmd_part)
-                if not (
-                    ret is None
-                    or ret.target.startswith("/etc")
-                    or ret.target.startswith("/lib")
-                    or ret.target.startswith("/usr/lib")
-                    or ret.target.startswith("/usr/share")
-                    or ret.target.startswith("/proc")
-                ):
-                    cr.open_fd(pid, ret, time_part)
-            elif cmd_part.startswith("read"):
-                ret = parse_read(cmd_part)
+    with open(src) as f:
+        convert_stream(f, cr)
+
+    if flush_dst is not None:
+        with open(flush_dst, "w") as f:
+            json.dump(cr.flush_summary(), f, indent=2)
+
+
+def convert_stream(lines: Iterable[str], cr: ContextRecorder):
+    pending_events: "dict[int, tuple[str, str]]" = {}
+
+    for l in lines:
+        if len(l) == 0:
+            continue
+
+        s = l.strip()
+
+        pid_part, time_part, cmd_part = re.split("\s+", s, 2)
+
+        pid = int(pid_part)
+
+        if cmd_part.endswith("<unfinished ...>"):
+            pending_events[pid] = (cmd_part, time_part)
+            continue
+
+        # 所要時間 (strace -T の出力があればそれを、なければ中断/再開の時刻差)
+        duration: Optional[float] = None
+        matched = REG_SYSCALL_TIME.search(cmd_part)
+        if matched is not None:
+            duration = float(matched.group(1))
+            cmd_part = cmd_part[: matched.start()]
+
+        if cmd_part.startswith("<..."):
+            # resume
+            pending_cmd, start_part = pending_events.pop(pid)
+            cmd_part = pending_cmd[:-17] + cmd_part[cmd_part.find(">") + 2 :]
+            if matched is None:
+                duration = elapsed(start_part, time_part)
+
+        # process
+        if cmd_part.startswith("execve"):
+            ret = parse_execve(cmd_part)
+            cr.add_process(0, pid, ret["name"], time_part)
+        elif cmd_part.startswith("clone"):
+            ret = parse_clone(cmd_part)
+            cr.clone_process(pid, ret["pid"], None, time_part)
+        elif cmd_part.startswith("exit_group"):
+            cr.close_process(pid, time_part)
+
+        # file / socket
+        elif cmd_part.startswith("open"):
+            ret = parse_open(cmd_part)
+            if not (
+                ret is None
+                or ret.target.startswith("/etc")
+                or ret.target.startswith("/lib")
+                or ret.target.startswith("/usr/lib")
+                or ret.target.startswith("/usr/share")
+                or ret.target.startswith("/proc")
+            ):
+                cr.open_fd(pid, ret, time_part)
+        elif cmd_part.startswith("read"):
+            ret = parse_read(cmd_part)
+            if ret["len"] > 0:
+                cr.read_fd(pid, ret["fd"], ret["len"], ret["content"], time_part)
+        elif cmd_part.startswith("write"):
+            ret = parse_write(cmd_part)
+            if ret is not None and ret["len"] > 0:
+                cr.write_fd(
+                    pid, ret["fd"], ret["len"], ret["content"], time_part, duration
+                )
+        elif cmd_part.startswith("close"):
+            ret = parse_close(cmd_part)
+            cr.close_fd(pid, ret["fd"], time_part)
+        elif cmd_part.startswith("unlink"):
+            ret = parse_unlink(cmd_part)
+        elif cmd_part.startswith("socket"):
+            ret = parse_socket(cmd_part)
+            cr.open_fd(pid, ret, time_part)
+        elif cmd_part.startswith("accept"):
+            ret = parse_accept(cmd_part)
+            cr.accept_sock(pid, ret["source"], ret["fd"], time_part)
+        elif cmd_part.startswith("bind"):
+            ret = parse_bind(cmd_part)
+            if ret is not None:
+                cr.bind_sock(pid, ret["fd"], ret["opt"], time_part)
+        elif cmd_part.startswith("connect"):
+            ret = parse_connect(cmd_part)
+            if ret is not None:
+                cr.connect_sock(pid, ret["fd"], ret["opt"], time_part)
+        elif cmd_part.startswith("listen"):
+            ret = parse_listen(cmd_part)
+            cr.listen_sock(pid, ret["fd"], time_part)
+        elif cmd_part.startswith("sendto"):
+            ret = parse_sendto(cmd_part)
+            if ret is not None:
                 if ret["len"] > 0:
-                    cr.read_fd(pid, ret["fd"], ret["len"], ret["content"], time_part)
-            elif cmd_part.startswith("write"):
-                ret = parse_write(cmd_part)
-                if ret is not None and ret["len"] > 0:
                     cr.write_fd(pid, ret["fd"], ret["len"], ret["content"], time_part)
-            elif cmd_part.startswith("close"):
-                ret = parse_close(cmd_part)
-                cr.close_fd(pid, ret["fd"], time_part)
-            elif cmd_part.startswith("unlink"):
-                ret = parse_unlink(cmd_part)
-            elif cmd_part.startswith("socket"):
-                ret = parse_socket(cmd_part)
-                cr.open_fd(pid, ret, time_part)
-            elif cmd_part.startswith("accept"):
-                ret = parse_accept(cmd_part)
-                cr.accept_sock(pid, ret["source"], ret["fd"], time_part)
-            elif cmd_part.startswith("bind"):
-                ret = parse_bind(cmd_part)
-                if ret is not None:
-                    cr.bind_sock(pid, ret["fd"], ret["opt"], time_part)
-            elif cmd_part.startswith("connect"):
-                ret = parse_connect(cmd_part)
-                if ret is not None:
-                    cr.connect_sock(pid, ret["fd"], ret["opt"], time_part)
-            elif cmd_part.startswith("listen"):
-                ret = parse_listen(cmd_part)
-                cr.listen_sock(pid, ret["fd"], time_part)
-            elif cmd_part.startswith("sendto"):
-                ret = parse_sendto(cmd_part)
-                if ret is not None:
-                    if ret["len"] > 0:
-                        cr.write_fd(
-                            pid, ret["fd"], ret["len"], ret["content"], time_part
-                        )
-            elif cmd_part.startswith("recvfrom"):
-                ret = parse_recvfrom(cmd_part)
-                if ret is not None:
-                    if ret["len"] > 0:
-                        cr.read_fd(
-                            pid, ret["fd"], ret["len"], ret["content"], time_part
-                        )
-
-            elif cmd_part.startswith("pipe"):
-                ret = parse_pipe(cmd_part)
-                cr.open_fd(pid, ret[0], time_part)
-                cr.open_fd(pid, ret[1], time_part)
-
-            elif cmd_part.startswith("epoll_create1"):
-                ret = parse_epoll_create1(cmd_part)
-                cr.open_fd(pid, ret, time_part)
-
-            elif cmd_part.startswith("mmap"):
-                ret = parse_mmap(cmd_part)
-                if ret is not None and ret["fd"] == -1:
-                    cr.manip_mem(pid, ret["addr"], ret["amount"], time_part)
-            elif cmd_part.startswith("munmap"):
-                ret = parse_munmap(cmd_part)
-                cr.manip_mem(pid, ret["addr"], -ret["amount"], time_part)
+        elif cmd_part.startswith("recvfrom"):
+            ret = parse_recvfrom(cmd_part)
+            if ret is not None:
+                if ret["len"] > 0:
+                    cr.read_fd(pid, ret["fd"], ret["len"], ret["content"], time_part)
 
-            elif cmd_part.startswith("kill"):
-                ret = parse_kill(cmd_part)
-                cr.send_signal(pid, ret["to"], ret["act"], time_part)
+        elif cmd_part.startswith("pipe"):
+            ret = parse_pipe(cmd_part)
+            cr.open_fd(pid, ret[0], time_part)
+            cr.open_fd(pid, ret[1], time_part)
+
+        elif cmd_part.startswith("epoll_create1"):
+            ret = parse_epoll_create1(cmd_part)
+            cr.open_fd(pid, ret, time_part)
+
+        elif cmd_part.startswith("mmap"):
+            ret = parse_mmap(cmd_part)
+            if ret is not None and ret["fd"] == -1:
+                cr.manip_mem(pid, ret["addr"], ret["amount"], time_part)
+        elif cmd_part.startswith("munmap"):
+            ret = parse_munmap(cmd_part)
+            cr.manip_mem(pid, ret["addr"], -ret["amount"], time_part)
+
+        elif cmd_part.startswith("kill"):
+            ret = parse_kill(cmd_part)
+            cr.send_signal(pid, ret["to"], ret["act"], time_part)
+
+        # flush
+        elif cmd_part.startswith("fsync") or cmd_part.startswith("fdatasync"):
+            ret = parse_fsync(cmd_part)
+            if ret is not None and ret["ret"] == 0:
+                syscall = cmd_part[: cmd_part.find("(")]
+                cr.flush_fd(pid, ret["fd"], syscall, 0, duration, time_part)
+        elif cmd_part.startswith("sync_file_range"):
+            ret = parse_sync_file_range(cmd_part)
+            if ret is not None and ret["ret"] == 0:
+                cr.flush_fd(
+                    pid,
+                    ret["fd"],
+                    "sync_file_range",
+                    ret["nbytes"],
+                    duration,
+                    time_part,
+                )
 
-            else:
-                pass
-                # print(f'Not supported {l}')
+        else:
+            pass
+            # print(f'Not supported {l}')
 
 
 if __name__ == "__main__":
     src = sys.argv[1]
     dst = sys.argv[2]
+    flush_dst = sys.argv[3] if len(sys.argv) > 3 else None
 
-    convert(src, dst)
+    convert(src, dst, flush_dst)
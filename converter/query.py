@@ -0,0 +1,304 @@
+from typing import Any, Iterator, Optional, Union
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+import copy
+import json
+import numbers
+
+from convert import ContextRecorder, convert_stream, parse_time
+
+
+PTable = "dict[int, dict[str, Any]]"
+TimeOrFrame = Union[int, str]
+
+
+def normalize_p_table(p_table: "dict[Any, Any]") -> PTable:
+    # jsonlから読むとキーが文字列になるのでpid/fdをintに戻す
+    ret = {}
+    for pid, p in p_table.items():
+        p = dict(p)
+        p["fd_table"] = {int(fd): f for fd, f in p["fd_table"].items()}
+        ret[int(pid)] = p
+    return ret
+
+
+def apply_event(p_table: PTable, evt: "dict[str, Any]"):
+    """
+    p_tableを持たないイベントの差分を適用する (viewerのApplyStraceEventに相当)
+    """
+    pid = evt["pid"]
+    if pid not in p_table:
+        return
+    p = p_table[pid]
+    name = evt["name"]
+
+    if name == "manip_mem":
+        p["memory"] += evt["amount"]
+        return
+
+    fd = evt.get("fd")
+    if fd not in p["fd_table"]:
+        return
+    f = p["fd_table"][fd]
+
+    if name == "read_fd":
+        f["r"] += evt["len"]
+    elif name == "write_fd":
+        f["w"] += evt["len"]
+    elif name == "bind":
+        f["family"] = evt["family"]
+        f["bind"] = evt["bind"]
+    elif name == "connect":
+        f["family"] = evt["family"]
+        f["target"] = evt["target"]
+    elif name == "listen":
+        f["is_out"] = False
+
+
+class Lifetime:
+    def __init__(self, pid: int, fd: Optional[int], start: int, info: Any):
+        """
+        parameters
+        ----------
+        pid:
+            プロセスID
+        fd:
+            ファイルディスクリプタ プロセスの場合はNone
+        start:
+            開始フレーム
+        info:
+            開始時点のプロセス/fdのdict ソケットはbind/connect/listenの結果を反映する
+        """
+        self.pid = pid
+        self.fd = fd
+        self.start = start
+        self.end: Optional[int] = None  # 終了フレーム 最後まで残った場合はNone
+        self.info = info
+
+    def __repr__(self):
+        return f"Lifetime: pid:{self.pid} fd:{self.fd} {self.start}-{self.end}"
+
+
+class Trace:
+    def __init__(self, records: "list[dict[str, Any]]", cache_size: int = 32):
+        """
+        parameters
+        ----------
+        records:
+            変換後のイベントレコード (jsonlの1行に相当)
+        cache_size:
+            復元した状態を保持するLRUキャッシュの大きさ
+        """
+        self.records = records
+        for r in self.records:
+            if r["p_table"] is not None:
+                r["p_table"] = normalize_p_table(r["p_table"])
+
+        self.keyframes = [i for i, r in enumerate(records) if r["p_table"] is not None]
+
+        # 日付をまたぐと時刻が戻るので単調増加になるように補正する
+        self.times: "list[float]" = []
+        offset = 0.0
+        for r in records:
+            t = parse_time(r["time"]) + offset
+            if self.times and t < self.times[-1] - 12 * 3600:
+                offset += 24 * 3600
+                t += 24 * 3600
+            self.times.append(t)
+
+        self.cache_size = cache_size
+        self.cache: "OrderedDict[int, PTable]" = OrderedDict()
+        self._lifetimes: "Optional[tuple[list[Lifetime], list[Lifetime]]]" = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def __repr__(self) -> str:
+        return f"Trace: {len(self.records)} events {len(self.keyframes)} keyframes"
+
+    @classmethod
+    def load(cls, fname: str, cache_size: int = 32) -> "Trace":
+        """変換済みjsonlを読み込む"""
+        with open(fname) as f:
+            records = [json.loads(l) for l in f if len(l.strip()) > 0]
+        return cls(records, cache_size)
+
+    @classmethod
+    def from_strace(cls, fname: str, cache_size: int = 32) -> "Trace":
+        """straceログをファイルに書き出さずに変換して読み込む"""
+        records = []
+        cr = ContextRecorder(sink=records.append)
+        with open(fname) as f:
+            convert_stream(f, cr)
+        return cls(records, cache_size)
+
+    def frame_at(self, time_or_frame: TimeOrFrame) -> int:
+        """
+        時刻(19:40:44.504078形式)ならその時刻以前の最後のフレームを返す
+        時刻より前にイベントがなければ-1
+        """
+        if isinstance(time_or_frame, numbers.Integral):
+            if not (0 <= time_or_frame < len(self.records)):
+                raise IndexError(f"frame out of events count. {time_or_frame}")
+            return int(time_or_frame)
+
+        return bisect_right(self.times, self._seconds(time_or_frame)) - 1
+
+    def _seconds(self, time_part: str) -> float:
+        if not isinstance(time_part, str):
+            raise TypeError(
+                f"frame (int) or time (str) expected. {type(time_part).__name__}"
+            )
+        t = parse_time(time_part)
+        # ログが日付をまたいでいる場合のみ、先頭より前の時刻を翌日とみなす
+        if self.times and self.times[-1] >= 24 * 3600 and t < self.times[0]:
+            t += 24 * 3600
+        return t
+
+    def state_at(self, time_or_frame: TimeOrFrame) -> PTable:
+        """
+        指定フレーム/時刻の直後のプロセスツリー(p_table)を返す
+        直近のキーフレームから差分を適用して復元する
+        """
+        frame = self.frame_at(time_or_frame)
+        if frame < 0:
+            return {}
+
+        if frame in self.cache:
+            self.cache.move_to_end(frame)
+            return copy.deepcopy(self.cache[frame])
+
+        # 直近のp_tableを持つイベントレコードまで遡る
+        i = bisect_right(self.keyframes, frame) - 1
+        key_frame = self.keyframes[i] if i >= 0 else -1
+
+        # キーフレームより後でキャッシュ済みのフレームがあればそこから適用する
+        base = key_frame
+        for cached in self.cache:
+            if base < cached < frame:
+                base = cached
+
+        if base == -1:
+            p_table = {}
+        elif base == key_frame:
+            p_table = copy.deepcopy(self.records[key_frame]["p_table"])
+        else:
+            p_table = copy.deepcopy(self.cache[base])
+
+        # 差分適用
+        for r in self.records[base + 1 : frame + 1]:
+            apply_event(p_table, r["event"])
+
+        self.cache[frame] = p_table
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        return copy.deepcopy(p_table)
+
+    def events(
+        self,
+        pid: Optional[int] = None,
+        fd: Optional[int] = None,
+        name: Optional[str] = None,
+        between: "Optional[tuple[TimeOrFrame, TimeOrFrame]]" = None,
+    ) -> "Iterator[tuple[int, dict[str, Any]]]":
+        """
+        条件に合うイベントを(フレーム, レコード)で返す
+        betweenは(開始, 終了)のフレームまたは時刻で両端を含む
+        """
+        start, end = 0, len(self.records) - 1
+        if between is not None:
+            if isinstance(between[0], numbers.Integral):
+                start = max(int(between[0]), 0)
+            else:
+                start = bisect_left(self.times, self._seconds(between[0]))
+            if isinstance(between[1], numbers.Integral):
+                end = min(int(between[1]), end)
+            else:
+                end = self.frame_at(between[1])
+
+        for i in range(start, end + 1):
+            evt = self.records[i]["event"]
+            if pid is not None and evt.get("pid") != pid:
+                continue
+            if fd is not None and evt.get("fd") != fd:
+                continue
+            if name is not None and evt["name"] != name:
+                continue
+            yield i, self.records[i]
+
+    def _build_lifetimes(self) -> "tuple[list[Lifetime], list[Lifetime]]":
+        procs: "list[Lifetime]" = []
+        fds: "list[Lifetime]" = []
+        alive_procs: "dict[int, Lifetime]" = {}
+        alive_fds: "dict[tuple[int, int], Lifetime]" = {}
+
+        def open_fd(i, pid, fd, info):
+            lt = Lifetime(pid, fd, i, dict(info))
+            alive_fds[(pid, fd)] = lt
+            fds.append(lt)
+
+        def close_fd(i, pid, fd):
+            lt = alive_fds.pop((pid, fd), None)
+            if lt is not None:
+                lt.end = i
+
+        for i, r in enumerate(self.records):
+            evt = r["event"]
+            name = evt["name"]
+            pid = evt["pid"]
+            if name == "add_proc":
+                p = r["p_table"][pid]
+                info = {k: v for k, v in p.items() if k != "fd_table"}
+                lt = Lifetime(pid, None, i, info)
+                alive_procs[pid] = lt
+                procs.append(lt)
+                # cloneで引き継いだfd
+                for fd, f in p["fd_table"].items():
+                    open_fd(i, pid, fd, f)
+            elif name == "close_proc":
+                lt = alive_procs.pop(pid, None)
+                if lt is not None:
+                    lt.end = i
+                for key in [k for k in alive_fds if k[0] == pid]:
+                    close_fd(i, *key)
+            elif name in ("open_fd", "accept"):
+                fd = evt["fd"]
+                close_fd(i, pid, fd)
+                open_fd(i, pid, fd, r["p_table"][pid]["fd_table"][fd])
+            elif name == "close_fd":
+                close_fd(i, pid, evt["fd"])
+            elif name in ("bind", "connect", "listen"):
+                # ソケットの接続先などは開いた後に決まる
+                lt = alive_fds.get((pid, evt["fd"]))
+                if lt is not None:
+                    apply_event({pid: {"fd_table": {lt.fd: lt.info}}}, evt)
+
+        return procs, fds
+
+    def lifetimes(self) -> "tuple[list[Lifetime], list[Lifetime]]":
+        if self._lifetimes is None:
+            self._lifetimes = self._build_lifetimes()
+        return self._lifetimes
+
+    def process_lifetimes(self, pid: Optional[int] = None) -> "list[Lifetime]":
+        return [lt for lt in self.lifetimes()[0] if pid is None or lt.pid == pid]
+
+    def fd_lifetimes(
+        self, pid: Optional[int] = None, cls: Optional[str] = None
+    ) -> "list[Lifetime]":
+        """
+        parameters
+        ----------
+        cls:
+            SFile, SSocket, SStd, SEpoll, SPipe
+        """
+        return [
+            lt
+            for lt in self.lifetimes()[1]
+            if (pid is None or lt.pid == pid)
+            and (cls is None or lt.info["class"] == cls)
+        ]
+
+    def socket_lifetimes(self, pid: Optional[int] = None) -> "list[Lifetime]":
+        return self.fd_lifetimes(pid, "SSocket")
@@ -0,0 +1,48 @@
+import pytest
+
+from convert import ContextRecorder, convert_stream
+from query import Trace
+
+
+LOG = """\
+10    19:40:44.400000 execve("/usr/lib/postgresql/9.6/bin/postgres", ["postgres"], [/* 16 vars */]) = 0
+10    19:40:44.500000 open("base/1/2", O_RDWR) = 3
+10    19:40:44.600000 write(3, "abc", 8192) = 8192
+10    19:40:44.700000 close(3)          = 0
+"""
+
+
+def make_trace(log: str) -> Trace:
+    records = []
+    convert_stream(log.splitlines(), ContextRecorder(sink=records.append))
+    return Trace(records)
+
+
+def test_frame_at_time():
+    t = make_trace(LOG)
+    assert t.frame_at("19:40:00") == -1  # 先頭より前
+    assert t.frame_at("19:40:44.550000") == 1
+    assert t.frame_at("19:41:00") == len(t) - 1  # 末尾より後
+
+    assert t.state_at("19:40:00") == {}
+    assert 3 in t.state_at("19:40:44.550000")[10]["fd_table"]
+
+    assert len(list(t.events(between=("19:40:00", "19:40:44.650000")))) == 3
+    assert len(list(t.events(between=("19:41:00", "19:42:00")))) == 0
+
+
+def test_frame_at_across_midnight():
+    t = make_trace(
+        LOG.replace("19:40:44.600000", "23:59:59.900000").replace(
+            "19:40:44.700000", "00:00:00.100000"
+        )
+    )
+    assert t.frame_at("00:00:00.050000") == 2
+    assert t.frame_at("00:00:00.200000") == 3
+
+
+def test_frame_at_type():
+    t = make_trace(LOG)
+    assert t.frame_at(2) == 2
+    with pytest.raises(TypeError):
+        t.state_at(5.0)